@@ -3,7 +3,13 @@ import sys
 import random
 
 try:
+    import numpy as np
     import cupy as cp
+    import cupyx
+    from cupy._core import _accelerator
+    from cupyx.profiler import benchmark, time_range
+    # any/argmaxなどの集約処理にはCUBを使う
+    _accelerator.set_reduction_accelerators(['cub'])
     # 使用するGPUデバイスの情報を取得
     device_name = cp.cuda.runtime.getDeviceProperties(0)["name"].decode("utf-8")
     print(f"GPU検出: {device_name} (cupy)")
@@ -16,96 +22,337 @@ except Exception as e:
     sys.exit(1)
 
 
+# 1試行の配列はブロックの共有メモリ (48KB) にint32で置くので、これを超えるサイズは扱えない
+MAX_ARRAY_SIZE = 48 * 1024 // 4
+
 try:
 
     ARRAY_SIZE = int(input("配列サイズ (ARRAY_SIZE) を入力してください: "))
+    if not 1 <= ARRAY_SIZE <= MAX_ARRAY_SIZE:
+        raise ValueError(f"ARRAY_SIZEは1以上{MAX_ARRAY_SIZE}以下で指定してください")
 except (ValueError, KeyboardInterrupt):
     print("\n入力が中断されたか、無効な値です。終了します。")
     sys.exit(0)
 
-# パフォーマンス測定用のバッチサイズの候補リスト
-TEST_BATCHES = list(range(100_000, 1_000_000, 100_000)) + list(range(1_000_000, 10_000_001, 1_000_000))
+# 何バッチごとにホスト側で発見フラグを確認するか
+CHECK_INTERVAL = 32
+# 何バッチごとに進捗を表示するか (フラグ確認のタイミングに合わせてCHECK_INTERVALの倍数にする)
+PROGRESS_INTERVAL = CHECK_INTERVAL * 2
+
+# パフォーマンス測定で探索するバッチサイズの範囲と、探索を打ち切る区間幅
+MIN_BATCH = 100_000
+MAX_BATCH = 10_000_000
+SEARCH_RESOLUTION = 200_000
+INV_PHI = (5 ** 0.5 - 1) / 2
+
+# バッチサイズを変えながら確保と解放を繰り返すので、非同期アロケータで断片化と解放時の同期を避ける
+try:
+    memory_pool = cp.cuda.MemoryAsyncPool()
+    cp.cuda.set_allocator(memory_pool.malloc)
+except (RuntimeError, cp.cuda.runtime.CUDARuntimeError):
+    # CUDA 11.2未満などでストリーム順序付きアロケータが使えない場合は従来のメモリプールを使う
+    memory_pool = cp.get_default_memory_pool()
+memory_pool.set_limit(fraction=0.9)
+
+# 乱数生成→シャッフル→ソート済み判定を1カーネルで行う (1ブロック = 1試行)
+# N (= ARRAY_SIZE) はコンパイル時定数として埋め込み、ループを展開させる
+_SHUFFLE_CHECK_SOURCE = r'''
+#include <curand_kernel.h>
+
+// 目標の状態 (全SMから定数キャッシュ経由で読む)
+__constant__ int target[N];
+
+// Philox4_32_10は1回で4個の乱数を生成するので、n回目の乱数をバッファから順に取り出す
+__device__ __forceinline__
+unsigned int philox_next(curandStatePhilox4_32_10_t* state, uint4* buf, int n)
+{
+    switch (n & 3) {
+    case 0:
+        *buf = curand4(state);
+        return buf->x;
+    case 1:
+        return buf->y;
+    case 2:
+        return buf->z;
+    default:
+        return buf->w;
+    }
+}
+
+extern "C" __global__
+void shuffle_check(unsigned long long seed, int B, int* sample, bool* results)
+{
+    __shared__ int perm[N];
+    const int trial = blockIdx.x;
+    if (trial >= B) return;
+    // 試行0だけは進捗表示のサンプルとして最後までシャッフルし、sampleに書き出す
+    const bool keep_row = (trial == 0);
+
+    #pragma unroll
+    for (int j = threadIdx.x; j < N; j += BLOCK_SIZE) {
+        perm[j] = j;
+    }
+    __syncthreads();
+
+    // Fisher-Yates: 後ろから位置kの値を確定させ、その都度ソート済みかを判定する
+    if (threadIdx.x == 0) {
+        curandStatePhilox4_32_10_t state;
+        curand_init(seed, trial, 0, &state);
+        uint4 buf;
+        bool is_identity = true;
+        #pragma unroll 32
+        for (int k = N - 1; k > 0; --k) {
+            int r = philox_next(&state, &buf, N - 1 - k) % (k + 1);
+            int tmp = perm[k];
+            perm[k] = perm[r];
+            perm[r] = tmp;
+            if (perm[k] != target[k]) {
+                is_identity = false;
+                // 確定した位置が合わなければソート済みにはなり得ないので、ほとんどの試行は1回目で打ち切られる
+                if (!keep_row) break;
+            }
+        }
+        results[trial] = is_identity && (perm[0] == target[0]);
+    }
+    if (!keep_row) return;
+    __syncthreads();
+
+    #pragma unroll
+    for (int j = threadIdx.x; j < N; j += BLOCK_SIZE) {
+        sample[j] = perm[j];
+    }
+}
+
+#if N <= 8
+// N <= 8 なら順列は4bit x N要素でuint32に収まるので、1スレッド = 1試行で、そのuint32の上で直接ニブルを入れ替えてシャッフルする (状態は1レジスタに収まる)
+extern "C" __global__
+void shuffle_pack(unsigned long long seed, int B, unsigned int* out)
+{
+    const int trial = blockIdx.x * blockDim.x + threadIdx.x;
+    if (trial >= B) return;
+
+    unsigned int packed = 0;
+    #pragma unroll
+    for (int k = 0; k < N; ++k) {
+        packed |= k << (4 * k);
+    }
+
+    curandStatePhilox4_32_10_t state;
+    curand_init(seed, trial, 0, &state);
+    uint4 buf;
+    #pragma unroll
+    for (int k = N - 1; k > 0; --k) {
+        int r = philox_next(&state, &buf, N - 1 - k) % (k + 1);
+        // 位置kと位置rのニブルをXORで入れ替える (r == k なら何も変わらない)
+        unsigned int diff = ((packed >> (4 * k)) ^ (packed >> (4 * r))) & 0xF;
+        packed ^= (diff << (4 * k)) | (diff << (4 * r));
+    }
+    out[trial] = packed;
+}
+#endif
+'''
+BLOCK_SIZE = min(ARRAY_SIZE, 256)
+# ARRAY_SIZEが決まった時点で一度だけコンパイルしておく
+_kernel_module = cp.RawModule(
+    code=_SHUFFLE_CHECK_SOURCE,
+    options=(f"-DN={ARRAY_SIZE}", f"-DBLOCK_SIZE={BLOCK_SIZE}"),
+)
+_shuffle_check_kernel = _kernel_module.get_function("shuffle_check")
+
+# 目標の状態はホスト側に持ち、定数メモリへ一度だけ転送しておく
+sorted_arr = np.arange(ARRAY_SIZE, dtype=np.int32)
+_kernel_module.get_global("target").copy_from_host(sorted_arr.ctypes.data, sorted_arr.nbytes)
 
-# GPU用配列を準備
-sorted_arr = cp.arange(ARRAY_SIZE, dtype=cp.int32).reshape(1, -1)
+# ARRAY_SIZE <= 8 のときは順列を1つのuint32に詰めて扱い、ソート済みかは定数との比較だけで判定する
+PACKED = ARRAY_SIZE <= 8
+if PACKED:
+    _shuffle_pack_kernel = _kernel_module.get_function("shuffle_pack")
+    PACKED_IDENTITY = sum(int(v) << (4 * k) for k, v in enumerate(sorted_arr))
 
-def try_batch(batch_size, sync=False):
+# 1試行あたりに必要なGPUメモリ (シャッフル結果 + 判定結果)
+TRIAL_BYTES = (4 if PACKED else 0) + 1
+
+def empty_shuffled(batch_size):
+    """シャッフル結果を書き込むバッファを確保する (パックしない場合は試行0の1行だけを保持する)"""
+    if PACKED:
+        return cp.empty(batch_size, dtype=cp.uint32)
+    return cp.empty((1, ARRAY_SIZE), dtype=cp.int32)
+
+def row_to_list(row):
+    """ホストに転送した1試行分のシャッフル結果をリストに戻す"""
+    if PACKED:
+        packed = int(row)
+        return [(packed >> (4 * k)) & 0xF for k in range(ARRAY_SIZE)]
+    return row.tolist()
+
+def shuffle_check(shuffled, results, seed):
+    """batch_size回シャッフルし、ソート済みになった試行をresultsに記録する (同じseedなら同じ結果)"""
+    batch_size = results.shape[0]
+    if PACKED:
+        _shuffle_pack_kernel(
+            ((batch_size + 255) // 256,),
+            (256,),
+            (cp.uint64(seed), cp.int32(batch_size), shuffled),
+        )
+        cp.equal(shuffled, PACKED_IDENTITY, out=results)
+        return
+    _shuffle_check_kernel(
+        (batch_size,),
+        (BLOCK_SIZE,),
+        (cp.uint64(seed), cp.int32(batch_size), shuffled, results),
+    )
+
+def find_hit(seeds, shuffled, results):
+    """直近のバッチを同じシードで順に再実行し、最初にソート済みになった試行の通し番号 (0始まり) を返す"""
+    batch_size = results.shape[0]
+    for n, seed in enumerate(seeds):
+        shuffle_check(shuffled, results, seed)
+        if results.any():
+            # バッチ内で最初に成功した配列のインデックスをGPU上で取得
+            return n * batch_size + cp.argmax(results).item()
+    return None
+
+def try_batch(batch_size):
     try:
-        start = time.time()
-        rnd = cp.random.rand(batch_size, ARRAY_SIZE)
-        idx = cp.argsort(rnd, axis=1)
-        _ = cp.take_along_axis(sorted_arr, idx, axis=1)
-        if sync:
-            cp.cuda.Stream.null.synchronize()
-        elapsed = time.time() - start
+        shuffled = empty_shuffled(batch_size)
+        results = cp.empty(batch_size, dtype=cp.bool_)
+        # 起動時間ではなくGPU上の実行時間をCUDAイベントで測る
+        perf = benchmark(
+            shuffle_check,
+            (shuffled, results, random.getrandbits(64)),
+            n_repeat=3,
+            n_warmup=1,
+        )
+        elapsed = perf.gpu_times.mean()
         return batch_size / elapsed if elapsed > 0 else 0
     except cp.cuda.memory.OutOfMemoryError:
-        cp._default_memory_pool.free_all_blocks()
+        # 上限を縮めて探索を続けるので、キャッシュされたブロックを返しておく
+        memory_pool.free_all_blocks()
         return None
     except Exception as e:
         print(f"バッチ試行中にエラーが発生しました: {e}")
         raise
 
+def probe_batch(batch_size):
+    """バッチサイズを1つ試して速度を表示する (メモリ不足ならNone)"""
+    print(f"  試行中: {batch_size:10,d} ...", end="", flush=True)
+    # 本処理ではダブルバッファで2バッチ分確保するので、その分が空いていなければ試さない
+    if 2 * batch_size * TRIAL_BYTES > memory_pool.get_limit() - memory_pool.used_bytes():
+        speed = None
+    else:
+        speed = try_batch(batch_size)
+    if speed is None:
+        print(" メモリ不足")
+    else:
+        print(f" 速度: {speed:,.0f} 回/秒")
+    return speed
+
+@time_range()
 def find_optimal_batch():
-    """最適なバッチサイズを探索する"""
+    """最適なバッチサイズを黄金分割探索で求める (速度はバッチサイズに対して単峰と仮定)"""
     print("最適なバッチサイズを探索中...")
-    best_speed, best_batch = 0, 0
-    for b in TEST_BATCHES:
-        print(f"  試行中: {b:10,d} ...", end="", flush=True)
-        speed = try_batch(b, sync=False)
-        if speed is None:
-            print(" メモリ不足")
-            break
-        print(f" 速度: {speed:,.0f} 回/秒")
-        if speed > best_speed:
-            best_speed, best_batch = speed, b
+    # 初回はメモリプールの拡張などで遅くなり判定が狂うので、結果を捨てて一度空回しする
+    try_batch(MIN_BATCH)
+    speeds = {}
+    lo, hi = MIN_BATCH, MAX_BATCH
+    m1 = m2 = None
+    while hi - lo > SEARCH_RESOLUTION:
+        # 分割点を黄金比で取ると、区間を縮めたあとも片方の点の測定結果をそのまま使い回せる
+        # メモリ不足になったバッチサイズは上限として区間を縮め、分割点を取り直す
+        # (m1が収まらなければそれより大きいm2も収まらないので、m2は試さない)
+        if m1 is None:
+            m1 = int(hi - (hi - lo) * INV_PHI)
+            if m1 not in speeds:
+                speeds[m1] = probe_batch(m1)
+        if speeds[m1] is None:
+            hi, m1, m2 = m1, None, None
+            continue
+        if m2 is None:
+            m2 = int(lo + (hi - lo) * INV_PHI)
+            if m2 not in speeds:
+                speeds[m2] = probe_batch(m2)
+        if speeds[m2] is None:
+            # 元のm1は区間[lo, m2]の黄金分割点そのものなので、新しいm2として使い回す
+            hi, m1, m2 = m2, None, m1
+        elif speeds[m1] < speeds[m2]:
+            lo, m1, m2 = m1, m2, None
         else:
-            print(f"\n探索完了。最適バッチサイズを採用: {best_batch:,} (ピーク速度: {best_speed:,.0f} 回/秒)\n")
-            return best_batch
-    if best_batch == 0:
+            hi, m1, m2 = m2, None, m1
+    if lo not in speeds and all(speed is None for speed in speeds.values()):
+        # 区間が下限付近まで縮んだ場合は下限そのものを試す
+        speeds[lo] = probe_batch(lo)
+    measured = {b: speed for b, speed in speeds.items() if speed is not None}
+    if not measured:
         print("\nエラー: 実行可能なバッチサイズが見つかりませんでした。メモリが不足している可能性があります。")
         sys.exit(1)
-    print(f"\n探索完了。最大バッチサイズを採用: {best_batch:,} (ピーク速度: {best_speed:,.0f} 回/秒)\n")
+    best_batch = max(measured, key=measured.get)
+    best_speed = measured[best_batch]
+    print(f"\n探索完了。最適バッチサイズを採用: {best_batch:,} (ピーク速度: {best_speed:,.0f} 回/秒)\n")
     return best_batch
 
 def main():
     """メインの計算処理"""
     print("\n" + "=" * 50)
     print("ボゴソートを開始します。")
-    target_list_str = str(sorted_arr.get().tolist()[0])
+    target_list_str = str(sorted_arr.tolist())
     print(f"目標の状態: {target_list_str}")
-    initial_rnd = cp.random.rand(1, ARRAY_SIZE)
-    initial_idx = cp.argsort(initial_rnd, axis=1)
-    initial_shuffled = cp.take_along_axis(sorted_arr, initial_idx, axis=1)
-    initial_list = initial_shuffled.get().tolist()[0]
-    print(f"開始時の状態: {str(initial_list)}")
+    # 大きな配列では開始時の状態の生成と転送自体が重いので省略する
+    if ARRAY_SIZE <= 20:
+        initial_rnd = cp.random.random((1, ARRAY_SIZE), dtype=cp.float32)
+        initial_shuffled = cp.argsort(initial_rnd, axis=1)
+        initial_list = initial_shuffled.get().tolist()[0]
+        print(f"開始時の状態: {str(initial_list)}")
+    else:
+        print("開始時の状態: (省略)")
     print("=" * 50 + "\n")
 
     batch_size = find_optimal_batch()
 
     total_count = 0
     start_time = time.time()
+    # ループ内で毎回確保しないよう、作業用バッファを事前に確保しておく
+    # 2本のストリームでダブルバッファリングし、次のバッチの計算と前のバッチの判定を重ねる
+    # MemoryAsyncPoolの確保はストリーム順序付きなので、各バッファは使うストリーム上で確保する
+    # (nullストリームで確保・ゼロ埋めすると非ブロッキングストリームと順序付けされない)
+    streams = [cp.cuda.Stream(non_blocking=True) for _ in range(2)]
+    shuffled, results = [], []
+    # 発見フラグはGPU上に溜めておき、CHECK_INTERVALバッチごとにまとめて確認する
+    found_acc = []
+    for stream in streams:
+        with stream:
+            shuffled.append(empty_shuffled(batch_size))
+            results.append(cp.empty(batch_size, dtype=cp.bool_))
+            found_acc.append(cp.zeros((), dtype=cp.bool_))
+    done = [cp.cuda.Event() for _ in range(2)]
+    # 進捗表示用のサンプルは別ストリームからピン留めメモリへコピーする
+    sample_stream = cp.cuda.Stream(non_blocking=True)
+    host_sample = cupyx.empty_pinned(shuffled[0].shape[1:], dtype=shuffled[0].dtype)
+    seeds = []
+    iter_idx = 0
     try:
         print("計算を開始します... (Ctrl+Cで中断)")
         while True:
-            rnd = cp.random.rand(batch_size, ARRAY_SIZE)
-            idx = cp.argsort(rnd, axis=1)
-            shuffled = cp.take_along_axis(sorted_arr, idx, axis=1)
-
-            results = cp.all(shuffled == sorted_arr, axis=1)
-            found = cp.any(results)
-
+            cur = iter_idx % 2
+            seed = random.getrandbits(64)
+            with streams[cur]:
+                shuffle_check(shuffled[cur], results[cur], seed)
+                found_acc[cur] |= results[cur].any()
+                done[cur].record()
+            seeds.append(seed)
 
             total_count += batch_size
+            iter_idx += 1
 
-            if found:
-                # バッチ内で最初に成功した配列のインデックスをGPU上で取得
-                found_index_gpu = cp.argmax(results)
-                
-                found_index_cpu = found_index_gpu.item()
-                
+            if iter_idx % CHECK_INTERVAL != 0:
+                continue
+            for event in done:
+                event.synchronize()
+
+            # 再実行しても見つからなければ誤検出なので、フラグを戻して探索を続ける
+            hit_index = find_hit(seeds, shuffled[0], results[0]) if found_acc[0] or found_acc[1] else None
+            if hit_index is not None:
                 # 正確な試行回数を計算
-                exact_count = (total_count - batch_size) + (found_index_cpu + 1)
+                exact_count = (total_count - len(seeds) * batch_size) + (hit_index + 1)
 
                 elapsed = time.time() - start_time
                 speed = total_count / elapsed if elapsed > 0 else 0
@@ -117,14 +364,20 @@ def main():
                 print(f"  - 平均速度: {speed:,.2f} 回/秒")
                 print("-" * 50)
                 break
-            
 
-            if total_count % (batch_size * 50) == 0:
+            for stream, flag in zip(streams, found_acc):
+                with stream:
+                    flag.fill(False)
+            seeds.clear()
+
+            if iter_idx % PROGRESS_INTERVAL == 0:
                 elapsed = time.time() - start_time
                 speed = total_count / elapsed if elapsed > 0 else 0
-                sample_idx = random.randint(0, batch_size - 1)
-                sample_gpu = shuffled[sample_idx]
-                sample_list = sample_gpu.get().tolist()
+                # 各試行は独立なので、サンプルには常に試行0の結果を使う
+                sample_gpu = shuffled[cur][0]
+                # 計算用ストリームは確認時に同期済みなので、サンプル用ストリーム上で同期コピーするだけでよい
+                sample_gpu.get(stream=sample_stream, out=host_sample)
+                sample_list = row_to_list(host_sample)
                 if ARRAY_SIZE <= 20:
                     sample_str = str(sample_list)
                 else: